@@ -1,10 +1,11 @@
 # coop.py
 import os
 import datetime
+import httpx
 import pandas as pd
 import streamlit as st
 from typing import Optional, Dict, Any
-from supabase import create_client, Client
+from supabase import create_client, Client, ClientOptions
 
 # =========================
 # Config & Setup
@@ -16,142 +17,252 @@ st.set_page_config(
 )
 
 COOP_NAME = "NAAT Multipurpose Cooperative JOSTUM"
+MEMBERS_PAGE_SIZE = 1000  # PostgREST's default max rows per response
+MEMBER_COLUMNS = "id,name,email,role,savings_balance,loan_balance"
 
 # -------------------------
 # Supabase Credentials
 # -------------------------
+@st.cache_resource
+def load_config() -> Dict[str, str]:
+    """Read the Supabase credentials from st.secrets once per process"""
+    return {"url": st.secrets["SUPABASE_URL"], "key": st.secrets["SUPABASE_KEY"]}
+
 try:
-    SUPABASE_URL = st.secrets["SUPABASE_URL"]
-    SUPABASE_KEY = st.secrets["SUPABASE_KEY"]
+    _cfg = load_config()
+    SUPABASE_URL, SUPABASE_KEY = _cfg["url"], _cfg["key"]
 except Exception:
     st.error("❌ Supabase credentials missing. Please add SUPABASE_URL and SUPABASE_KEY to your Streamlit Cloud secrets.")
     st.stop()
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+@st.cache_resource
+def get_http_client() -> httpx.Client:
+    """Pooled keep-alive HTTP client; same http2/redirect defaults as supabase-py's own"""
+    return httpx.Client(
+        http2=True,
+        follow_redirects=True,
+        timeout=10,
+        limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=60.0),
+    )
+
+@st.cache_resource
+def get_supabase() -> Client:
+    """Build the Supabase client once and share it across reruns and sessions"""
+    # With httpx_client set, supabase-py ignores the *_client_timeout options;
+    # the timeout lives on the httpx client instead.
+    return create_client(SUPABASE_URL, SUPABASE_KEY, options=ClientOptions(httpx_client=get_http_client()))
+
+# The shared client is for anonymous data reads only. Signing in stores the
+# user's JWT on the client it runs on, so every auth call goes through the
+# per-session client from get_session_client().
+supabase: Client = get_supabase()
+
+def get_session_client() -> Client:
+    """Supabase client owned by this browser session, used for auth calls"""
+    if "session_client" not in st.session_state:
+        # No token auto-refresh: its timer thread would keep the client alive
+        # after the browser session ends, and the JWT is only used at sign-in.
+        st.session_state.session_client = create_client(
+            SUPABASE_URL,
+            SUPABASE_KEY,
+            options=ClientOptions(httpx_client=get_http_client(), auto_refresh_token=False),
+        )
+    return st.session_state.session_client
 
 # -------------------------
 # Helpers to handle responses
 # -------------------------
 def resp_data(resp):
-    """Extract data from Supabase response object or dict"""
-    try:
-        d = getattr(resp, "data", None)
-        if d is not None:
-            return d
-    except Exception:
-        pass
-    if isinstance(resp, dict):
-        return resp.get("data") or resp.get("result") or resp.get("body")
-    return None
+    """Rows (or the row, for maybe_single) from a PostgREST response"""
+    return resp.data
 
 def resp_user(resp):
-    """Extract user object from Supabase auth response"""
-    try:
-        user = getattr(resp, "user", None)
-        if user:
-            return user
-    except Exception:
-        pass
-    d = resp_data(resp)
-    if isinstance(d, dict):
-        if "user" in d:
-            return d["user"]
-        session = d.get("session")
-        if isinstance(session, dict) and "user" in session:
-            return session["user"]
-    if isinstance(resp, dict):
-        return resp.get("user")
-    return None
+    """User object from a Supabase auth response"""
+    return resp.user
 
 # =========================
 # Session state
 # =========================
+# Streamlit's runner.fastReruns is on by default, so a new run can start
+# while an old one is still executing. Always assign new values to session
+# state keys; never mutate a stored list/dict in place.
 for key, default in {
     "user_email": None,
     "user_id": None,
+    "member": None,
     "page": "Login",
 }.items():
     if key not in st.session_state:
         st.session_state[key] = default
 
+def set_state(key: str, value: Any):
+    """Assign a session-state key only when the value actually changes"""
+    if st.session_state.get(key) != value:
+        st.session_state[key] = value
+
+ANON_NAV = ["Login", "Register"]
+
+def go_to(page: str):
+    """Switch page from a callback, keeping the sidebar radio ("nav") in step"""
+    set_state("page", page)
+    if page in ANON_NAV:
+        set_state("nav", page)
+
+def on_nav_change():
+    set_state("page", st.session_state.nav)
+
 # =========================
 # Utilities
 # =========================
+_NAIRA = "₦{:,.2f}".format
+
 def format_naira(amount: Optional[float]) -> str:
+    if amount is None:
+        return "₦0.00"
     try:
-        return f"₦{float(amount):,.2f}"
-    except Exception:
+        return _NAIRA(float(amount))
+    except (TypeError, ValueError):
         return "₦0.00"
 
-def get_member_by_email(email: str) -> Optional[Dict[str, Any]]:
-    resp = supabase.table("members").select("*").eq("email", email).limit(1).execute()
-    data = resp_data(resp) or []
-    return data[0] if data else None
+def fetch_member(client: Client, email: str, columns: str = MEMBER_COLUMNS) -> Optional[Dict[str, Any]]:
+    resp = client.table("members").select(columns).eq("email", email).maybe_single().execute()
+    # maybe_single() returns no response at all when nothing matches
+    return resp_data(resp) if resp else None
+
+def get_members_bulk(ids) -> Dict[str, Dict[str, Any]]:
+    """Fetch several members by id in one request; use instead of per-row lookups"""
+    ids = list(ids)
+    if not ids:
+        return {}
+    resp = supabase.table("members").select("id,name,email,role").in_("id", ids).execute()
+    return {row["id"]: row for row in (resp_data(resp) or [])}
+
+@st.cache_data(ttl=5)
+def members_version() -> str:
+    """Change stamp for members, bumped on every write (sql/004_members_version.sql)"""
+    resp = supabase.table("members_version").select("changed_at").eq("id", 1).maybe_single().execute()
+    return resp_data(resp)["changed_at"] if resp else ""
+
+# The members map is cached per members_version() and shared across sessions,
+# so writes from anywhere (this app or the Supabase dashboard) are picked up
+# within the version's 5s cache window, without explicit invalidation. Treat
+# the dicts as read-only.
+@st.cache_resource(max_entries=1)
+def _members_map_for(version: str) -> Dict[str, Dict[str, str]]:
+    members = {}
+    start = 0
+    while True:
+        resp = (
+            supabase.table("members")
+            .select("id,name,email,role")
+            .order("id")
+            .range(start, start + MEMBERS_PAGE_SIZE - 1)
+            .execute()
+        )
+        rows = resp_data(resp) or []
+        for row in rows:
+            members[row["id"]] = {
+                "name": row.get("name", ""),
+                "email": row.get("email", ""),
+                "role": row.get("role", "member"),
+            }
+        if len(rows) < MEMBERS_PAGE_SIZE:
+            return members
+        start += MEMBERS_PAGE_SIZE
+
+@st.cache_resource(max_entries=1)
+def _roles_for(version: str) -> Dict[str, str]:
+    return {v["email"]: v["role"] for v in _members_map_for(version).values()}
 
-@st.cache_data(ttl=60)
 def get_members_map() -> Dict[str, Dict[str, str]]:
-    resp = supabase.table("members").select("id,name,email,role").execute()
-    rows = resp_data(resp) or []
-    return {
-        row["id"]: {
-            "name": row.get("name", ""),
-            "email": row.get("email", ""),
-            "role": row.get("role", "member"),
-        }
-        for row in rows
-    }
+    return _members_map_for(members_version())
+
+def get_role_by_email() -> Dict[str, str]:
+    return _roles_for(members_version())
 
 def is_admin(email: str) -> bool:
-    m = get_member_by_email(email)
-    return (m or {}).get("role") == "admin"
+    return get_role_by_email().get(email) == "admin"
+
+def is_admin_cached() -> bool:
+    """Role of the signed-in user, from the member record captured at login"""
+    return (st.session_state.get("member") or {}).get("role") == "admin"
 
 # =========================
 # Auth: login / signup / logout / reset
 # =========================
+def normalize_email(email: str) -> str:
+    """Member emails are stored lower-case (sql/003_members_email_lower.sql)"""
+    return (email or "").strip().lower()
+
 def login(email: str, password: str) -> bool:
+    email = normalize_email(email)
+    client = get_session_client()
     try:
-        resp = supabase.auth.sign_in_with_password({"email": email, "password": password})
+        resp = client.auth.sign_in_with_password({"email": email, "password": password})
         user = resp_user(resp)
-        if user:
-            st.session_state.user_email = user.get("email") if isinstance(user, dict) else getattr(user, "email", None)
-            st.session_state.user_id = user.get("id") if isinstance(user, dict) else getattr(user, "id", None)
-            st.session_state.page = "Admin" if is_admin(st.session_state.user_email) else "Member"
-            return True
-        st.error("❌ Login failed: Invalid credentials or no user returned.")
+        if not user:
+            st.error("❌ Login failed: Invalid credentials or no user returned.")
+            return False
+        # Read the member as the signed-in user, so RLS sees their JWT. Session
+        # keys are only set once this succeeds, so a failed lookup leaves the
+        # user signed out rather than half logged in.
+        member = fetch_member(client, user.email)
     except Exception as e:
+        try:
+            client.auth.sign_out()
+        except Exception:
+            pass
         st.error(f"❌ Login failed: {e}")
-    return False
+        return False
+    st.session_state.user_email = user.email
+    st.session_state.user_id = user.id
+    st.session_state.member = member
+    set_state("page", "Admin" if is_admin_cached() else "Member")
+    return True
 
 def logout():
     try:
-        supabase.auth.sign_out()
+        get_session_client().auth.sign_out()
     except Exception:
         pass
     st.session_state.user_email = None
     st.session_state.user_id = None
-    st.session_state.page = "Login"
+    st.session_state.member = None
+    go_to("Login")
+
+def is_duplicate_error(e: Exception) -> bool:
+    """True for unique-violation / already-registered errors from Postgres or Auth"""
+    text = f"{getattr(e, 'code', '')} {e}".lower()
+    return any(s in text for s in ("23505", "duplicate", "already registered", "already_exists"))
 
 def signup(name: str, email: str, password: str) -> bool:
+    email = normalize_email(email)
     try:
-        if get_member_by_email(email):
+        # The members row is created by the on_auth_user_created trigger
+        # (sql/002_handle_new_user.sql) from the name in the user metadata.
+        resp = get_session_client().auth.sign_up({
+            "email": email,
+            "password": password,
+            "options": {"data": {"name": name}}
+        })
+        # With email confirmation on, Auth does not raise for an existing email;
+        # it returns an obfuscated user with no identities and creates nothing.
+        user = resp_user(resp)
+        if user is not None and not user.identities:
             st.error("⚠️ Email already registered. Please log in instead.")
             return False
-        supabase.auth.sign_up({"email": email, "password": password})
-        supabase.table("members").insert({
-            "name": name,
-            "email": email,
-            "savings_balance": 0,
-            "loan_balance": 0,
-            "role": "member"
-        }).execute()
         return True
     except Exception as e:
-        st.error(f"❌ Signup failed: {e}")
+        if is_duplicate_error(e):
+            st.error("⚠️ Email already registered. Please log in instead.")
+        else:
+            st.error(f"❌ Signup failed: {e}")
         return False
 
 def send_password_reset(email: str):
+    email = normalize_email(email)
     try:
-        supabase.auth.reset_password_for_email(
+        get_session_client().auth.reset_password_for_email(
             email,
             options={"redirect_to": "http://localhost:8501"}
         )
@@ -163,39 +274,42 @@ def get_member_required() -> Dict[str, Any]:
     if not st.session_state.user_email:
         st.error("Not authenticated.")
         st.stop()
-    m = get_member_by_email(st.session_state.user_email)
+    m = st.session_state.member or fetch_member(get_session_client(), st.session_state.user_email)
     if not m:
         st.error("Member record not found.")
         st.stop()
+    set_state("member", m)
     return m
 
 # =========================
 # Pages
 # =========================
+# Form submits run as on_click callbacks: the Supabase calls happen once per
+# click, before the rerun, so the rerun already renders the resulting state.
+def on_login_submit():
+    login(st.session_state.login_email, st.session_state.login_password)
+
+def on_register_submit():
+    ss = st.session_state
+    if signup(ss.register_name, ss.register_email, ss.register_password):
+        st.success("✅ Registration successful! Please log in.")
+        go_to("Login")
+
 def page_login():
     st.title(f"{COOP_NAME} – Login")
     with st.form("login_form"):
-        email = st.text_input("Email")
-        password = st.text_input("Password", type="password")
-        submitted = st.form_submit_button("Login")
-    if submitted and login(email, password):
-        st.success("✅ Logged in successfully.")
-        st.experimental_rerun()
-    if st.button("🔄 Reset Password"):
-        st.session_state.page = "ForgotPassword"
-        st.experimental_rerun()
+        st.text_input("Email", key="login_email")
+        st.text_input("Password", type="password", key="login_password")
+        st.form_submit_button("Login", on_click=on_login_submit)
+    st.button("🔄 Reset Password", on_click=go_to, args=("ForgotPassword",))
 
 def page_register():
     st.title(f"Register – {COOP_NAME}")
     with st.form("register_form"):
-        name = st.text_input("Full Name")
-        email = st.text_input("Email")
-        password = st.text_input("Password", type="password")
-        submitted = st.form_submit_button("Create Account")
-    if submitted and signup(name, email, password):
-        st.success("✅ Registration successful! Please log in.")
-        st.session_state.page = "Login"
-        st.experimental_rerun()
+        st.text_input("Full Name", key="register_name")
+        st.text_input("Email", key="register_email")
+        st.text_input("Password", type="password", key="register_password")
+        st.form_submit_button("Create Account", on_click=on_register_submit)
 
 def page_forgot_password():
     st.title("🔄 Reset Your Password")
@@ -207,6 +321,7 @@ def page_forgot_password():
             send_password_reset(email)
         else:
             st.warning("⚠️ Please enter your email.")
+    st.button("⬅️ Back to Login", on_click=go_to, args=("Login",))
 
 def page_admin_dashboard():
     st.title("👨‍💼 Admin Dashboard")
@@ -223,30 +338,24 @@ with st.sidebar:
     st.markdown(f"## 🏦 {COOP_NAME}")
     if st.session_state.user_email:
         st.write(f"**Signed in:** {st.session_state.user_email}")
-        if is_admin(st.session_state.user_email):
+        if is_admin_cached():
             choice = st.radio("Go to", ["Admin", "Member"], index=0 if st.session_state.page == "Admin" else 1)
         else:
             choice = "Member"
-        if st.button("Logout"):
-            logout()
-            st.experimental_rerun()
-        st.session_state.page = choice
+        st.button("Logout", on_click=logout)
+        set_state("page", choice)
     else:
-        choice = st.radio("Go to", ["Login", "Register"], index=0 if st.session_state.page == "Login" else 1)
-        st.session_state.page = choice
+        # Keyed, and only writes the page when the user picks an entry, so
+        # callbacks (go_to) can navigate without the radio overriding them.
+        st.radio("Go to", ANON_NAV, key="nav", on_change=on_nav_change)
 
 # =========================
 # Router
 # =========================
+PAGES_AUTHED = {"Admin": page_admin_dashboard, "Member": page_member_dashboard}
+PAGES_ANON = {"Login": page_login, "Register": page_register, "ForgotPassword": page_forgot_password}
+
 if st.session_state.user_email:
-    if st.session_state.page == "Admin":
-        page_admin_dashboard()
-    else:
-        page_member_dashboard()
+    PAGES_AUTHED.get(st.session_state.page, page_member_dashboard)()
 else:
-    if st.session_state.page == "Register":
-        page_register()
-    elif st.session_state.page == "ForgotPassword":
-        page_forgot_password()
-    else:
-        page_login()
+    PAGES_ANON.get(st.session_state.page, page_login)()
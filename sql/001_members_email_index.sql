@@ -0,0 +1,2 @@
+-- Every login, signup and member lookup filters members by email.
+create unique index if not exists members_email_key on public.members (email);
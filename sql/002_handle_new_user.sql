@@ -0,0 +1,19 @@
+-- Create the members row in the same transaction as the auth user, so
+-- signup is a single request and cannot leave an orphaned auth account.
+create or replace function public.handle_new_user()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+begin
+  insert into public.members (id, email, name, savings_balance, loan_balance, role)
+  values (new.id, new.email, new.raw_user_meta_data ->> 'name', 0, 0, 'member');
+  return new;
+end;
+$$;
+
+drop trigger if exists on_auth_user_created on auth.users;
+create trigger on_auth_user_created
+  after insert on auth.users
+  for each row execute function public.handle_new_user();
@@ -0,0 +1,40 @@
+-- Emails are compared case-insensitively: coop.py lower-cases addresses
+-- before querying, and this index keeps "A@x.com" / "a@x.com" from both
+-- being stored.
+
+-- Lower-casing rows that differ only by case would violate members_email_key
+-- (001); stop with the offending addresses so they can be merged by hand.
+do $$
+declare
+  dupes text;
+begin
+  select string_agg(e, ', ') into dupes
+  from (
+    select lower(email) as e from public.members group by lower(email) having count(*) > 1
+  ) d;
+  if dupes is not null then
+    raise exception 'members has emails differing only by case: %. Merge or remove them, then rerun this migration.', dupes;
+  end if;
+end;
+$$;
+
+update public.members set email = lower(email) where email <> lower(email);
+
+-- Both unique indexes stay: members_email_key (001) serves the app's
+-- .eq("email", ...) lookups, which cannot use an expression index, while
+-- this one enforces case-insensitive uniqueness for rows written outside
+-- the app (dashboard edits, other clients).
+create unique index if not exists members_email_lower_key on public.members (lower(email));
+
+create or replace function public.handle_new_user()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+begin
+  insert into public.members (id, email, name, savings_balance, loan_balance, role)
+  values (new.id, lower(new.email), new.raw_user_meta_data ->> 'name', 0, 0, 'member');
+  return new;
+end;
+$$;
@@ -0,0 +1,29 @@
+-- Single-row change stamp for the members cache in coop.py. Bumped once per
+-- statement on any insert/update/delete/truncate, so the app can detect
+-- deletes too with a primary-key read instead of scanning members.
+create table if not exists public.members_version (
+  id int primary key default 1 check (id = 1),
+  changed_at timestamptz not null default now()
+);
+insert into public.members_version (id) values (1) on conflict (id) do nothing;
+
+alter table public.members_version enable row level security;
+drop policy if exists members_version_read on public.members_version;
+create policy members_version_read on public.members_version for select using (true);
+
+create or replace function public.bump_members_version()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+begin
+  update public.members_version set changed_at = clock_timestamp() where id = 1;
+  return null;
+end;
+$$;
+
+drop trigger if exists members_bump_version on public.members;
+create trigger members_bump_version
+  after insert or update or delete or truncate on public.members
+  for each statement execute function public.bump_members_version();